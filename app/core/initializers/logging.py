@@ -23,7 +23,7 @@ def add_application_metadata(logger, method_name, event_dict):
 
 
 def initialize_logging():
-    timestamper = structlog.processors.TimeStamper(fmt="iso")
+    timestamper = structlog.processors.TimeStamper(fmt="iso", utc=True)
 
     shared_processors = [
         structlog.stdlib.add_logger_name,
@@ -5,14 +5,19 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
-import glob
+import os
+import re
 import shutil
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from enum import Enum
-from os.path import basename, splitext
+from functools import cached_property
+from importlib.util import find_spec
 from pathlib import Path
-from typing import List
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import structlog
 import xarray as xr
@@ -21,6 +26,82 @@ from app.routers.weather.utils.geo_position import GeoPosition
 from app_config import get_setting
 
 
+# Ranking of the suffixes to decide which file to keep when several exist for the same identifier. Permanent files
+# (without a suffix) always win. TEMP trumps INCOMPLETE because in the normal process incomplete files will always be
+# replaced with temporary files. Any other suffix ranks lowest.
+_SUFFIX_RANKING = {"": 2, "TEMP": 1, "INCOMPLETE": 0}
+
+
+# h5netcdf is an optional dependency. It only reads NetCDF4 files, which are recognised by their HDF5 signature.
+_H5NETCDF_AVAILABLE = find_spec("h5netcdf") is not None
+_HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+def _preferred_engine(file: Path) -> Optional[str]:
+    """
+        Returns the Xarray backend engine to read a file with: h5netcdf for NetCDF4 files if it is installed, as it
+        avoids the overhead of the netCDF4 library for every variable, and None (Xarray's default) otherwise.
+    """
+    if _H5NETCDF_AVAILABLE:
+        with open(file, "rb") as f:
+            if f.read(len(_HDF5_SIGNATURE)) == _HDF5_SIGNATURE:
+                return "h5netcdf"
+    return None
+
+
+class _CleanupRecord(NamedTuple):
+    moment: float  # The moment of the cleanup, as given by time.monotonic()
+    oldest_identifier: Optional[str]  # The oldest identifier remaining in the repository after the cleanup
+
+
+# The last cleanup per repository folder. Kept outside of the repository instances, as some models create a new
+# repository instance for every request.
+_last_cleanups: Dict[Path, _CleanupRecord] = {}
+
+
+# The lazily opened repository files per path, together with the modification time of the file when it was opened.
+# Kept in the order of their last use, so the least recently used file is closed first when the cache is full.
+_opened_files: "OrderedDict[str, Tuple[int, xr.Dataset]]" = OrderedDict()
+_opened_files_lock = threading.Lock()
+_OPENED_FILES_MAXSIZE = 128  # Matches the default file_cache_maxsize of Xarray
+
+
+def _open_cached(file: str) -> xr.Dataset:
+    """
+        Opens a repository file lazily and keeps the opened dataset for later requests. Only the metadata is read
+        here; data is read from disk when (a selection of) the dataset is loaded.
+        The values are not CF decoded (scaling, masking, time units), so that decoding can be limited to the selected
+        part of the data using xr.decode_cf().
+        A file that was replaced on disk since it was opened is closed and opened again.
+    """
+    mtime_ns = os.stat(file).st_mtime_ns
+
+    with _opened_files_lock:
+        if file in _opened_files:
+            opened_mtime_ns, ds = _opened_files.pop(file)
+            if opened_mtime_ns == mtime_ns:
+                _opened_files[file] = (opened_mtime_ns, ds)
+                return ds
+            # Closed before opening the file again, so the file handle of the replaced file can't be reused
+            ds.close()
+
+        ds = xr.open_dataset(file, mask_and_scale=False, decode_cf=False)
+        _opened_files[file] = (mtime_ns, ds)
+
+        if len(_opened_files) > _OPENED_FILES_MAXSIZE:
+            _, (_, least_recently_used_ds) = _opened_files.popitem(last=False)
+            least_recently_used_ds.close()
+        return ds
+
+
+def _close_cached(file: Optional[str] = None):
+    """ Closes and forgets the opened dataset for a file, or for all files if no file is given """
+    with _opened_files_lock:
+        for opened_file in [file] if file is not None else list(_opened_files):
+            if opened_file in _opened_files:
+                _opened_files.pop(opened_file)[1].close()
+
+
 class RepositoryUpdateResult(Enum):
     failure = 0
     completed = 1
@@ -56,8 +137,11 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
             - permanent_suffixes:   Contains a list of suffixes that can be added to the repository files to
                                     indicate that the file should not be deleted. Any file not matching the prefix
                                     or having a suffix not matching this list will be deleted upon cleanup.
+                                    (Stored as a frozenset for fast lookups)
             - file_identifier_length:   This is the length in characters that the unique identifier part of the
                                         filename takes up. Usually this is based on a datetime.
+            - cleanup_interval:     Contains the minimum time between two cleanups triggered by gathering data from
+                                    the repository, in seconds.
 
         """
         self.repository_folder = Path(get_setting("REPO_FOLDER")).joinpath(
@@ -71,6 +155,41 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
         self.last_day_of_repo = None
         self.permanent_suffixes = None
         self.file_identifier_length = None
+        self.cleanup_interval = 60 * 5  # seconds * minutes (5 minutes default)
+
+    @property
+    def repository_folder(self) -> Path:
+        return self._repository_folder
+
+    @repository_folder.setter
+    def repository_folder(self, folder: Path):
+        self._repository_folder = Path(folder)
+        # The cached values below are derived from the folder, so they are rebuilt on first use after a change
+        self.__dict__.pop("_prefix_path_str", None)
+
+    @property
+    def permanent_suffixes(self) -> frozenset:
+        return self._permanent_suffixes
+
+    @permanent_suffixes.setter
+    def permanent_suffixes(self, suffixes):
+        self._permanent_suffixes = frozenset(suffixes or ())
+
+    @cached_property
+    def _prefix_path_str(self) -> str:
+        """ The full path of the repository files up to and including the file prefix, as a string """
+        return str(self.repository_folder.joinpath(self.file_prefix))
+
+    @cached_property
+    def _file_name_pattern(self) -> re.Pattern:
+        """
+        The compiled pattern matching valid repository file names, capturing their identifier and suffix. Only depends
+        on the file_prefix and file_identifier_length, which are set once by the repository itself.
+        """
+        return re.compile(
+            rf"^{re.escape(self.file_prefix)}_(?P<identifier>.{{{self.file_identifier_length}}})"
+            r"(?:_(?P<suffix>[^.]+))?\.nc$"
+        )
 
     @abstractmethod
     def _get_repo_sub_folder(self):
@@ -81,18 +200,13 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
         This function checks whether or not the repository folder already exists (starting from its parent folder)
         and creates it, if it (or its parent folder) don't exist yet.
         """
-        if not Path(
-                self.repository_folder
-        ).exists():  # If the folder doesn't exist yet, create it
-            self.logger.debug(
-                f"Attempting to create folder[{self.repository_folder}]",
-                datetime=datetime.utcnow(),
-            )
+        folder = self.repository_folder
+        if not folder.exists():  # If the folder doesn't exist yet, create it
+            self.logger.debug(f"Attempting to create folder[{folder}]")
             try:
                 # If the main folder for all repositories doesn't exist yet, create it..
-                if not Path(self.repository_folder).parent.exists():
-                    Path(self.repository_folder).parent.mkdir()
-                Path(self.repository_folder).mkdir()
+                folder.parent.mkdir(exist_ok=True)
+                folder.mkdir(exist_ok=True)
             except OSError as e:
                 self.logger.error(f"An error occurred creating the directory: {e}")
                 raise e
@@ -104,19 +218,47 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
         Any files not matching the pattern required for the Repository shall be deleted.
         """
         self._validate_repo_folder()
-        self.logger.debug(
-            f"Verifying existing files for {self.repository_name} in [{self.repository_folder}]",
-            datetime=datetime.utcnow(),
-        )
+        self.logger.debug(f"Verifying existing files for {self.repository_name} in [{self.repository_folder}]")
+
+        # The folder is scanned only once. Every step below passes on the files that it didn't delete
+        repository_files = self._scan_repo()
 
         # Delete any files that aren't of a permanent type
-        self._delete_non_permanent_files()
+        repository_files = self._delete_non_permanent_files(repository_files)
 
-        # First we delete any files that are too old or new to be valid
-        self._delete_files_outside_of_scope()
+        # Then we delete any files that are too old or new to be valid
+        repository_files = self._delete_files_outside_of_scope(repository_files)
 
-        # Only one file may exist per month. Select the proper file to remain and remove any others
-        self._delete_excess_files()
+        # Only one file may exist per identifier. Select the proper file to remain and remove any others
+        files_per_identifier = self._delete_excess_files(repository_files)
+
+        # Identifiers are date based, so the lowest identifier belongs to the oldest file
+        _last_cleanups[self.repository_folder] = _CleanupRecord(
+            moment=time.monotonic(), oldest_identifier=min(files_per_identifier, default=None)
+        )
+
+    def _cleanup_if_due(self):
+        """
+        A function that runs the cleanup, unless the repository folder was already cleaned up less than cleanup_interval
+        seconds ago.
+        """
+        last_cleanup = _last_cleanups.get(self.repository_folder)
+        if last_cleanup is None or time.monotonic() - last_cleanup.moment > self.cleanup_interval:
+            self.cleanup()
+
+    def _scan_repo(self) -> List[os.DirEntry]:
+        """
+            A function that lists all of the NetCDF files in the repository folder that start with the repository's
+            file prefix, using a single pass over the folder.
+        Returns:
+            A list of os.DirEntry objects for the matching files.
+        """
+        with os.scandir(self.repository_folder) as entries:
+            return [
+                entry
+                for entry in entries
+                if entry.name.startswith(self.file_prefix) and entry.name.endswith(".nc")
+            ]
 
     @abstractmethod
     def update(self):
@@ -137,163 +279,171 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
             the requested coordinates.
 
         """
-        self.cleanup()
-        self.logger.debug(
-            f"Gathering repository data for the period of {begin} to {end}",
-            datetime=datetime.utcnow(),
-        )
+        self._cleanup_if_due()
+        self.logger.debug(f"Gathering repository data for the period of {begin} to {end}")
 
         # Get a list of files matching the requested period
         file_list = self._get_file_list_for_period(begin, end)
 
         if len(file_list) == 0:
             oldest_file = self.get_oldest_repository_file()
-            self.logger.error(
-                f"No files were found for the period of {begin} to {end}",
-                datetime=datetime.utcnow(),
-            )
+            self.logger.error(f"No files were found for the period of {begin} to {end}")
             raise FileNotFoundError(
                 f"The [{self.repository_name}] repository does not contain data for the period of [{begin.date()}] to "
                 f"[{end.date()}]. To preserve storage this repository only stores up to the file holding the date of "
-                f"[{self.first_day_of_repo.date()}]"
+                f"[{self.first_day_of_repo.date()}]. The oldest file currently in the repository is [{oldest_file}]"
             )
 
-        # Load files into datasets, select the requested data and aggregate that into a single dataset
-        ds = xr.Dataset()
-        for file in file_list:
-            ds_temp = xr.open_dataset(file).load()
+        # The requested coordinates are the same for every file, so they are rounded to the grid only once
+        grid_coordinates = self.get_grid_coordinates(coordinates)
 
-            ds_temp = self._filter_dataset_by_coordinates(coordinates, ds_temp)
-            if file == file_list[0]:
-                ds = ds_temp
-            else:
-                ds = ds.combine_first(ds_temp)
+        # Load files into datasets, select the requested data and aggregate that into a single dataset
+        parts = [self._load_file_selection(file, grid_coordinates) for file in sorted(file_list)]
+
+        # The parts only hold the requested locations, so combining them is cheap. Where files overlap in time (as
+        # predictions do), the values of the earliest file are kept, and only its missing values are filled by the
+        # later files.
+        ds = parts[0]
+        for part in parts[1:]:
+            ds = ds.combine_first(part)
         return ds
 
-    def load_file(self, file: Path) -> xr.Dataset:
+    def _load_file_selection(self, file: str, grid_coordinates: List[GeoPosition]) -> xr.Dataset:
+        """
+            A function that loads the data for a list of locations from a single repository file
+        Args:
+            file:               The filename (in string format) of the repository file to load the data from
+            grid_coordinates:   A list of GeoPositions, already rounded to the repository grid, that the data is
+                                requested for
+        Returns:
+            An Xarray Dataset containing the decoded weather data of the file for the requested coordinates.
+        """
+        ds = _open_cached(str(file))
+
+        # Only the data for the selected coordinates is actually read from the file, and decoded afterwards
+        return xr.decode_cf(self._filter_dataset_by_coordinates(grid_coordinates, ds).load())
+
+    def load_file(self, file: Path, engine: Optional[str] = None) -> xr.Dataset:
         """
             A function that loads and returns the full data for a specific repository file as an Xarray Dataset
         Args:
             file:   The filename (in the Path format by PathLib) specifying the file to load
+            engine: The Xarray backend engine to use. If not given, h5netcdf is used for NetCDF4 files when it is
+                    installed, and Xarray's default engine otherwise.
         Returns:
             An Xarray Dataset containing all of the weather data held within the specified file.
 
         """
         if file.exists():
-            with xr.open_dataset(file) as ds:
-                ds.load()
-            return ds
+            # The file is closed after loading, as callers may want to overwrite it afterwards
+            with xr.open_dataset(file, engine=engine or _preferred_engine(file)) as ds:
+                return ds.load()
 
         # Raise a FileNotFoundError if the file doesn't exist
-        self.logger.error(
-            f"File [{str(file)} does not exist]", datetime=datetime.utcnow()
-        )
+        self.logger.error(f"File [{str(file)} does not exist]")
         raise FileNotFoundError
 
     def purge_repository(self):
         """
         Function to fully delete the repository's folder and create a new clean one. Use with care!
         """
-        self.logger.warning(
-            f"Purging the entire repository folder for {self.repository_name}!",
-            datetime=datetime.utcnow(),
-        )
+        self.logger.warning(f"Purging the entire repository folder for {self.repository_name}!")
+        _close_cached()
         shutil.rmtree(self.repository_folder, ignore_errors=True)
+        _last_cleanups.pop(self.repository_folder, None)
         self._validate_repo_folder()  # Rebuild the folder after deletion
 
-    def _delete_non_permanent_files(self):
+    def _delete_non_permanent_files(self, repository_files: List[os.DirEntry]) -> List[os.DirEntry]:
         """
-        A function that deletes any and all files in the repository's folder that are not considered permanent in
-        nature. Only the files matching either repository files without a suffix or those with suffix listed in the
-        permanent_suffixes field are allowed.
-        Every other file should be deleted from the repository immediately.
+            A function that deletes any and all files in the repository's folder that are not considered permanent in
+            nature. Only the files matching either repository files without a suffix or those with suffix listed in the
+            permanent_suffixes field are allowed.
+            Every other file should be deleted from the repository immediately.
+        Args:
+            repository_files:   A list of os.DirEntry objects for the repository files to check.
+        Returns:
+            A list of os.DirEntry objects for the files that were not deleted.
         """
         # TODO: Enhance the detection of files that do not belong in the folder.
         #       A repository folder should only have repository files..
-        len_filename_until_after_date = (
-                len(str(self.repository_folder.joinpath(self.file_prefix)))
-                + self.file_identifier_length
-                + 2
-        )
-        for file_name in glob.glob(
-                str(self.repository_folder.joinpath(self.file_prefix)) + "*.nc"
-        ):
-            file_suffix = file_name[len_filename_until_after_date:-3]
-            if len(file_suffix) != 0 and file_suffix not in self.permanent_suffixes:
+        remaining_files = []
+
+        for entry in repository_files:
+            match = self._file_name_pattern.match(entry.name)
+            file_suffix = match.group("suffix") if match else None
+
+            if match is None or (file_suffix is not None and file_suffix not in self.permanent_suffixes):
                 self.logger.debug(
-                    f"File [{file_name}] is not a permanent file for {self.repository_name} "
+                    f"File [{entry.path}] is not a permanent file for {self.repository_name} "
                     f"and needs to be deleted"
                 )
-                self._safely_delete_file(file_name)
+                self._safely_delete_file(entry.path)
+            else:
+                remaining_files.append(entry)
+
+        return remaining_files
 
     @abstractmethod
-    def _delete_files_outside_of_scope(self):
+    def _delete_files_outside_of_scope(self, repository_files: List[os.DirEntry]) -> List[os.DirEntry]:
         pass
 
-    def _delete_excess_files(self):
+    def _group_files_by_identifier(self, repository_files: List[os.DirEntry]) -> Dict[str, List[os.DirEntry]]:
         """
-        A function that selects the proper file to keep when more than one permanent file exists for a given
-        identifier. The other files are deleted.
+            A function that groups repository files by their identifier. Files not matching the repository file name
+            pattern, or having a suffix that isn't permanent, are left out.
+        Args:
+            repository_files:   A list of os.DirEntry objects for the repository files to group.
+        Returns:
+            A dictionary holding a list of os.DirEntry objects per identifier, sorted from the file that should be
+            used (and kept) for that identifier to the least preferable one.
         """
-        len_filename_until_date = (
-                len(str(self.repository_folder.joinpath(self.file_prefix))) + 1
-        )
-        file_list = glob.glob(
-            str(self.repository_folder.joinpath(self.file_prefix)) + "*.*"
-        )
-        identifier_list = list(
-            set(
-                [
-                    file[
-                    len_filename_until_date: len_filename_until_date
-                                             + self.file_identifier_length
-                    ]
-                    for file in file_list
-                ]
-            )
-        )
-
-        for identifier in identifier_list:
-            files_with_specific_identifier = glob.glob(
-                str(self.repository_folder.joinpath(self.file_prefix))
-                + "_"
-                + identifier
-                + "*.nc"
-            )
+        files_per_identifier = defaultdict(list)
+
+        for entry in repository_files:
+            match = self._file_name_pattern.match(entry.name)
+            if match is None:
+                continue  # Not a repository file
+
+            file_suffix = match.group("suffix") or ""
+            if file_suffix == "" or file_suffix in self.permanent_suffixes:
+                files_per_identifier[match.group("identifier")].append((entry, file_suffix))
+
+        # Sorting on the name as well keeps the outcome independent of the order in which the file system lists files
+        return {
+            identifier: [
+                entry for entry, _ in sorted(files, key=lambda file: (-_SUFFIX_RANKING.get(file[1], -1), file[0].name))
+            ]
+            for identifier, files in sorted(files_per_identifier.items())
+        }
+
+    def _delete_excess_files(self, repository_files: List[os.DirEntry]) -> Dict[str, os.DirEntry]:
+        """
+            A function that selects the proper file to keep when more than one permanent file exists for a given
+            identifier. The other files are deleted.
+        Args:
+            repository_files:   A list of os.DirEntry objects for the repository files to check.
+        Returns:
+            A dictionary holding the os.DirEntry object of the remaining file per identifier.
+        """
+        remaining_files = {}
 
+        for identifier, files_with_specific_identifier in self._group_files_by_identifier(repository_files).items():
             if len(files_with_specific_identifier) > 1:
                 self.logger.debug(
                     f"More than one file was found for identifier [{identifier}]"
                 )
-                file_to_retain = None
-                highest_ranking_suffix = None
-
-                for file in files_with_specific_identifier:
-                    suffix = file[
-                             len_filename_until_date + self.file_identifier_length + 1: -3
-                             ]
-
-                    if highest_ranking_suffix is None or suffix == "":
-                        highest_ranking_suffix = suffix
-                        file_to_retain = file
+                for entry in files_with_specific_identifier[1:]:
+                    self._safely_delete_file(entry.path)
+            remaining_files[identifier] = files_with_specific_identifier[0]
 
-                    # TEMP trumps INCOMPLETE because in the normal process incomplete files will always be replaced with
-                    # temporary files
-                    if highest_ranking_suffix == "INCOMPLETE" and suffix == "TEMP":
-                        highest_ranking_suffix = suffix
-                        file_to_retain = file
-
-                for file in files_with_specific_identifier:
-                    if file != file_to_retain:
-                        self._safely_delete_file(str(Path(file)))
+        return remaining_files
 
     def _safely_delete_file(self, file: str):
         """ Basic function to safely remove files from the repository if possible, and supply errors if not """
         try:
-            self.logger.debug(
-                f"Safely deleting file [{file}]", datetime=datetime.utcnow()
-            )
-            Path(file).unlink()
+            self.logger.debug(f"Safely deleting file [{file}]")
+            _close_cached(str(file))
+            os.remove(file)
         except OSError as e:
             self.logger.error(f"Could not safely delete file: {e}")
             raise OSError(f"Could not safely delete file: {file}")
@@ -304,48 +454,36 @@ class WeatherRepositoryBase(metaclass=ABCMeta):
         print("This method is abstract and should be overridden.")
 
     def _filter_dataset_by_coordinates(
-            self, coordinates: List[GeoPosition], ds: xr.Dataset
+            self, grid_coordinates: List[GeoPosition], ds: xr.Dataset
     ) -> xr.Dataset:
         """
             A function that filters a given Xarray Dataset down to the values matching a given list of locations.
         Args:
-            coordinates:    A list of GeoPositions that the data is requested for.
-            ds:             An Xarray Dataset containing the data to be filtered.
+            grid_coordinates:   A list of GeoPositions that the data is requested for, already rounded to the
+                                repository grid using get_grid_coordinates().
+            ds:                 An Xarray Dataset containing the data to be filtered.
         Returns:
             An Xarray Dataset containing only the weather data that matched the given list of coordinates.
         """
-        ds_selected = xr.Dataset()
-        coordinate_list = self.get_grid_coordinates(coordinates)
-
-        for coordinate in coordinate_list:
-            # First filter a single coordinate in the list
-            ds_single_coord = ds.stack(dimensions={"coord": ["lat", "lon"]})
-            ds_single_coord = ds_single_coord.where(
-                ds_single_coord.lat == coordinate.get_WGS84()[0], drop=True
-            )
-            ds_single_coord = ds_single_coord.where(
-                ds_single_coord.lon == coordinate.get_WGS84()[1], drop=True
-            )
-            ds_single_coord = ds_single_coord.unstack("coord")
-
-            # Then append this to a clean list
-            if coordinate == coordinate_list[0]:
-                ds_selected = ds_single_coord
-            else:
-                ds_selected = ds_selected.combine_first(ds_single_coord)
+        lats = list({coordinate.get_WGS84()[0] for coordinate in grid_coordinates})
+        lons = list({coordinate.get_WGS84()[1] for coordinate in grid_coordinates})
 
-        return ds_selected
+        # A single orthogonal selection on the lat and lon indices. Both are kept as dimensions, so the result can
+        # still be sliced per location by the serializers. Locations not present in the dataset are simply left out.
+        return ds.sel(lat=ds.lat.isin(lats), lon=ds.lon.isin(lons))
 
     @abstractmethod
     def get_grid_coordinates(self, coordinates: List[GeoPosition]) -> List[GeoPosition]:
         print("This method is abstract and should be overridden.")
         return [GeoPosition(0, 0)]
 
-    def get_oldest_repository_file(self):
-        oldest_file = Path(
-            self._get_file_list_for_period(
-                self.first_day_of_repo, self.last_day_of_repo
-            )[0]
-        )
-        oldest_file = splitext(basename(oldest_file))[0]
-        return oldest_file[len(self.file_prefix) + 1:]
+    def get_oldest_repository_file(self) -> Optional[str]:
+        """
+            A function that returns the identifier of the oldest file in the repository, as found during the last
+            cleanup of the repository folder.
+        Returns:
+            The identifier (in string format) of the oldest repository file, or None if the repository was empty or
+            hasn't been cleaned up yet.
+        """
+        last_cleanup = _last_cleanups.get(self.repository_folder)
+        return last_cleanup.oldest_identifier if last_cleanup else None
@@ -7,6 +7,7 @@
 
 import glob
 import math
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import List
@@ -106,7 +107,7 @@ class ERA5SLRepository(WeatherRepositoryBase):
                 return RepositoryUpdateResult.timed_out
 
             file_prefix = (
-                str(self.repository_folder.joinpath(self.file_prefix))
+                self._prefix_path_str
                 + "_"
                 + str(active_month_for_update.year)
                 + "_"
@@ -349,26 +350,21 @@ class ERA5SLRepository(WeatherRepositoryBase):
             target_location,
         )
 
-    def _delete_files_outside_of_scope(self):
+    def _delete_files_outside_of_scope(self, repository_files: List[os.DirEntry]) -> List[os.DirEntry]:
         """
             A function that deletes all files in the repository with a date not inside the repository's scope.
             All files labeled as either before or after the given scope will be deleted.
+        Args:
+            repository_files:   A list of os.DirEntry objects for the repository files to check.
         Returns:
-            Nothing. Successful means the all files outside of the scope were deleted.
+            A list of os.DirEntry objects for the files that lie inside of the scope and were not deleted.
         """
-        len_filename_until_date = (
-            len(str(self.repository_folder.joinpath(self.file_prefix))) + 1
-        )
+        remaining_files = []
 
-        for file_name in glob.glob(
-            str(self.repository_folder.joinpath(self.file_prefix)) + "*.nc"
-        ):
-            file_year = int(
-                file_name[len_filename_until_date : len_filename_until_date + 4]
-            )
-            file_month = int(
-                file_name[len_filename_until_date + 5 : len_filename_until_date + 7]
-            )
+        for entry in repository_files:
+            file_identifier = self._file_name_pattern.match(entry.name).group("identifier")
+            file_year = int(file_identifier[0:4])
+            file_month = int(file_identifier[5:7])
 
             if (
                 file_year < self.first_day_of_repo.year
@@ -383,10 +379,14 @@ class ERA5SLRepository(WeatherRepositoryBase):
                 )
             ):
                 self.logger.debug(
-                    f"Deleting file [{file_name}] because it does not lie in the "
+                    f"Deleting file [{entry.path}] because it does not lie in the "
                     f"repository scope ({self.first_day_of_repo, self.last_day_of_repo})"
                 )
-                self._safely_delete_file(file_name)
+                self._safely_delete_file(entry.path)
+            else:
+                remaining_files.append(entry)
+
+        return remaining_files
 
     def _get_file_list_for_period(self, start: datetime, end: datetime):
         """
@@ -397,20 +397,12 @@ class ERA5SLRepository(WeatherRepositoryBase):
         Returns:
             A list of files (in string format) that indicate the files containing data for the requested period.
         """
-        self.cleanup()
-
-        len_filename_until_date = (
-            len(str(self.repository_folder.joinpath(self.file_prefix))) + 1
-        )
-        full_list_of_files = glob.glob(
-            str(self.repository_folder.joinpath(self.file_prefix)) + "*.nc"
-        )
         list_of_filtered_files = []
-        for file in full_list_of_files:
-            file_year = int(file[len_filename_until_date : len_filename_until_date + 4])
-            file_month = int(
-                file[len_filename_until_date + 5 : len_filename_until_date + 7]
-            )
+
+        # Only the preferred file is used for every identifier, so a full cleanup isn't needed to resolve duplicates
+        for file_identifier, files in self._group_files_by_identifier(self._scan_repo()).items():
+            file_year = int(file_identifier[0:4])
+            file_month = int(file_identifier[5:7])
             date_for_filename = datetime(year=file_year, month=file_month, day=15)
 
             if (
@@ -419,7 +411,7 @@ class ERA5SLRepository(WeatherRepositoryBase):
                 < datetime(year=end.year, month=end.month, day=28)
             ):
                 # If the file is within the requested period, save it to the list of filtered files
-                list_of_filtered_files.append(file)
+                list_of_filtered_files.append(files[0].path)
 
         return list_of_filtered_files
 
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2019-2021 Alliander N.V.
+#
+# SPDX-License-Identifier: MPL-2.0
+
+# Generated from arome_var_map.json by scripts/generate_arome_var_map.py. Do not edit this file directly.
+
+arome_factors = {
+    "1": "mean_sea_level_pressure",
+    "6": "geopotential",
+    "11": "temperature",
+    "33": "u_component_of_wind",
+    "34": "v_component_of_wind",
+    "52": "relative_humidity",
+    "66": "snow_cover",
+    "67": "boundary_layer_height",
+    "71": "cloud_cover",
+    "73": "low_cloud_cover",
+    "74": "medium_cloud_cover",
+    "75": "high_cloud_cover",
+    "111": "net_short_wave_radiation",
+    "112": "net_long_wave_radiation",
+    "117": "global_radiation",
+    "122": "sensible_heat_flux",
+    "132": "latent_heat_flux",
+    "162": "u_component_max_squall",
+    "163": "v_component_max_squall",
+    "181": "_rain_water",
+    "184": "_snow_water",
+    "186": "cloud_base",
+    "201": "_graupel",
+    "SD Snow depth m": "snow_depth",
+    "T Temperature K": "temperature - Extra copy",
+}
@@ -5,6 +5,7 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 import glob
+import os
 import re
 import tarfile
 import tempfile
@@ -338,7 +339,7 @@ class AromeRepository(WeatherRepositoryBase):
                     ds = xr.merge([ds, ds_query])
 
         save_file_name = (
-                str(Path(self.repository_folder).joinpath(self.file_prefix))
+                self._prefix_path_str
                 + "_"
                 + str(prediction_time.year)
                 + str(prediction_time.month).zfill(2)
@@ -397,20 +398,23 @@ class AromeRepository(WeatherRepositoryBase):
                 self.logger.error(f"Could not delete [{file}]: {e}")
                 raise e
 
-    def _delete_files_outside_of_scope(self):
+    def _delete_files_outside_of_scope(self, repository_files: List[os.DirEntry]) -> List[os.DirEntry]:
         """
             A function that deletes all files in the repository with a date not inside the repository's scope.
             All files labeled as either before or after the given scope will be deleted.
+        Args:
+            repository_files:   A list of os.DirEntry objects for the repository files to check.
         Returns:
-            Nothing. Successful means the all files outside of the scope were deleted.
+            A list of os.DirEntry objects for the files that lie inside of the scope and were not deleted.
         """
-        len_filename_until_date = len(str(self.repository_folder.joinpath(self.file_prefix))) + 1
+        remaining_files = []
 
-        for file_name in glob.glob(str(self.repository_folder.joinpath(self.file_prefix)) + "*.nc"):
+        for entry in repository_files:
+            file_identifier = self._file_name_pattern.match(entry.name).group("identifier")
             file_date = datetime(
-                year=int(file_name[len_filename_until_date: len_filename_until_date + 4]),
-                month=int(file_name[len_filename_until_date + 4: len_filename_until_date + 6]),
-                day=int(file_name[len_filename_until_date + 6: len_filename_until_date + 8]),
+                year=int(file_identifier[0:4]),
+                month=int(file_identifier[4:6]),
+                day=int(file_identifier[6:8]),
                 hour=0,
                 minute=0,
                 second=0,
@@ -419,10 +423,14 @@ class AromeRepository(WeatherRepositoryBase):
 
             if file_date < self.first_day_of_repo or file_date > self.last_day_of_repo:
                 self.logger.debug(
-                    f"Deleting file [{file_name}] because it does not lie in the "
+                    f"Deleting file [{entry.path}] because it does not lie in the "
                     f"repository scope ({self.first_day_of_repo, self.last_day_of_repo})"
                 )
-                self._safely_delete_file(file_name)
+                self._safely_delete_file(entry.path)
+            else:
+                remaining_files.append(entry)
+
+        return remaining_files
 
     def _get_file_list_for_period(self, start: datetime, end: datetime):
         """
@@ -434,17 +442,19 @@ class AromeRepository(WeatherRepositoryBase):
             A list of files (in string format) that indicate the files containing data for the requested period.
         """
         self.logger.debug(f"Checking files in [{self.repository_folder}]")
-        len_filename_until_date = len(str(self.repository_folder.joinpath(self.file_prefix))) + 1
-
-        full_list_of_files = glob.glob(str(self.repository_folder.joinpath(self.file_prefix)) + "*.nc")
         list_of_filtered_files = []
 
-        for file in full_list_of_files:
+        for entry in self._scan_repo():
+            match = self._file_name_pattern.match(entry.name)
+            if match is None:
+                continue  # Not a repository file
+
+            file_identifier = match.group("identifier")
             file_date = datetime(
-                year=int(file[len_filename_until_date: len_filename_until_date + 4]),
-                month=int(file[len_filename_until_date + 4: len_filename_until_date + 6]),
-                day=int(file[len_filename_until_date + 6: len_filename_until_date + 8]),
-                hour=int(file[len_filename_until_date + 9: len_filename_until_date + 11]),
+                year=int(file_identifier[0:4]),
+                month=int(file_identifier[4:6]),
+                day=int(file_identifier[6:8]),
+                hour=int(file_identifier[9:11]),
                 minute=0,
                 second=0,
                 microsecond=0,
@@ -452,7 +462,7 @@ class AromeRepository(WeatherRepositoryBase):
 
             if start < file_date < end:
                 # If the file is within the requested period, save it to the list of filtered files
-                list_of_filtered_files.append(file)
+                list_of_filtered_files.append(entry.path)
 
         return list_of_filtered_files
 
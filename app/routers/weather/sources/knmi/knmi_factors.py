@@ -7,9 +7,9 @@
 
 # factor name mapping
 
-import json
-import os
+from types import MappingProxyType
 
+from app.routers.weather.sources.knmi.arome_var_map import arome_factors as _arome_factors
 
-with open(os.path.join(os.path.dirname(__file__), "arome_var_map.json"), "r") as _f:
-    arome_factors = json.load(_f)
+# Read-only, so the mapping can't be changed by any of its users
+arome_factors = MappingProxyType(_arome_factors)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2019-2021 Alliander N.V.
+#
+# SPDX-License-Identifier: MPL-2.0
+
+# Generates arome_var_map.py from arome_var_map.json, which remains the source of the AROME factor mapping.
+# Run this script again after every change to the JSON file.
+
+import json
+from pathlib import Path
+
+KNMI_SOURCE_FOLDER = Path(__file__).parent.parent.joinpath("app", "routers", "weather", "sources", "knmi")
+
+HEADER = '''#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2019-2021 Alliander N.V.
+#
+# SPDX-License-Identifier: MPL-2.0
+
+# Generated from arome_var_map.json by scripts/generate_arome_var_map.py. Do not edit this file directly.
+
+'''
+
+
+def generate_arome_var_map():
+    arome_factors = json.loads(KNMI_SOURCE_FOLDER.joinpath("arome_var_map.json").read_bytes())
+    lines = [f"    {json.dumps(code)}: {json.dumps(name)}," for code, name in arome_factors.items()]
+    KNMI_SOURCE_FOLDER.joinpath("arome_var_map.py").write_text(
+        HEADER + "arome_factors = {\n" + "\n".join(lines) + "\n}\n"
+    )
+
+
+if __name__ == "__main__":
+    generate_arome_var_map()
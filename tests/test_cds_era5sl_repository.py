@@ -20,6 +20,7 @@ import pytest
 import xarray as xr
 from dateutil.relativedelta import relativedelta
 
+from app.routers.weather.repository import repository
 from app.routers.weather.sources.cds.client.era5sl_repository import ERA5SLRepository
 from app.routers.weather.utils.geo_position import GeoPosition
 from app.routers.weather.utils.pandas_helpers import coords_to_pd_index
@@ -94,6 +95,53 @@ def test_era5sl_repository_cleanup(_get_mock_repository_dir: Path):
     assert Path(regular_file).exists()
 
 
+def test_era5sl_repository_cleanup_invalid_file_names(_get_mock_repository_dir: Path):
+    era5sl_repo = ERA5SLRepository()
+    era5sl_repo.repository_folder = _get_mock_repository_dir
+
+    # SETUP: Create a clean mock repo-folder with a valid repository file
+    if era5sl_repo.repository_folder.exists():
+        shutil.rmtree(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+    regular_file = Path(_get_mock_repository_dir / (_get_mock_prefix(datetime.utcnow()
+                                                                     - relativedelta(days=5)))).with_suffix('.nc')
+    open(regular_file, 'a').close()
+
+    # CLEANUP TEST 1:   Files with the repository prefix, but not matching the repository file name pattern exist
+    # Expected result:  Those files are removed, while the valid repository file remains
+    invalid_files = [Path(_get_mock_repository_dir / 'ERA5SL_broken.nc'),
+                     Path(_get_mock_repository_dir / 'ERA5SLwithout_separator.nc')]
+    for invalid_file in invalid_files:
+        open(invalid_file, 'a').close()
+    era5sl_repo.cleanup()
+
+    assert not any(invalid_file.exists() for invalid_file in invalid_files)
+    assert Path(regular_file).exists()
+
+
+def test_era5sl_repository_cleanup_if_due(_get_mock_repository_dir: Path):
+    era5sl_repo = ERA5SLRepository()
+    era5sl_repo.repository_folder = _get_mock_repository_dir
+
+    # SETUP: Create a clean mock repo-folder, which also registers a cleanup
+    if era5sl_repo.repository_folder.exists():
+        shutil.rmtree(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+    formatted_file = Path(str(_get_mock_repository_dir / _get_mock_prefix(datetime.utcnow())) + '_FORMATTED.nc')
+    open(formatted_file, 'a').close()
+
+    # CLEANUP TEST 1:   A cleanup is requested within the cleanup interval
+    # Expected result:  The cleanup is skipped and the non-permanent file remains
+    era5sl_repo._cleanup_if_due()
+    assert formatted_file.exists()
+
+    # CLEANUP TEST 2:   A cleanup is requested after the cleanup interval has passed
+    # Expected result:  The cleanup runs and the non-permanent file is removed
+    era5sl_repo.cleanup_interval = 0
+    era5sl_repo._cleanup_if_due()
+    assert not formatted_file.exists()
+
+
 def test_repository_should_file_update(_get_mock_repository_dir: Path):
     era5sl_repo = ERA5SLRepository()
     era5sl_repo.repository_folder = _get_mock_repository_dir
@@ -153,12 +201,13 @@ def test_repo_get_month_filename(_get_mock_repository_dir: Path):
     assert len(glob.glob(str(era5sl_repo.repository_folder.joinpath('ERA5SL')) + '*.*')) == 10  # Confirm file creation
 
     # FETCHING TEST 1:  All file-types exist, direct period result request
-    # Expected result:  Only the definitive file is returned, the rest is removed from the folder
+    # Expected result:  Only the definitive file is returned, the rest is left for the cleanup to remove
     file_prefix = era5sl_repo.repository_folder.joinpath(_get_mock_prefix(existing_dates[0]))
 
     result = era5sl_repo._get_file_list_for_period(existing_dates[0], existing_dates[0])
     assert len(result) == 1
     assert result == [(str(file_prefix) + '.nc')]
+    assert len(glob.glob(str(era5sl_repo.repository_folder.joinpath('ERA5SL')) + '*.*')) == 10
 
     # SETUP: Create a clean mock repo-folder with dummy-files for 2 dates
     if era5sl_repo.repository_folder.exists():
@@ -168,7 +217,7 @@ def test_repo_get_month_filename(_get_mock_repository_dir: Path):
     assert len(glob.glob(str(era5sl_repo.repository_folder.joinpath('ERA5SL')) + '*.*')) == 10  # Confirm file creation
 
     # FETCHING TEST 2:  All types but the definitive file exist, direct period result request
-    # Expected result:  Only the INCOMPLETE file is returned, the rest is removed from the folder
+    # Expected result:  Only the TEMP file is returned
     os.remove(Path(str(file_prefix) + ".nc"))
     result = era5sl_repo._get_file_list_for_period(existing_dates[0], existing_dates[0])
     assert len(result) == 1
@@ -182,7 +231,7 @@ def test_repo_get_month_filename(_get_mock_repository_dir: Path):
     assert len(glob.glob(str(era5sl_repo.repository_folder.joinpath('ERA5SL')) + '*.*')) == 10  # Confirm file creation
 
     # FETCHING TEST 3:  All types but the definitive and temporary types exist, direct period result request
-    # Expected result:  Only the INCOMPLETE file is returned, the rest is removed from the folder
+    # Expected result:  Only the INCOMPLETE file is returned
     os.remove(Path(str(file_prefix) + ".nc"))
     os.remove(Path(str(file_prefix) + "_TEMP.nc"))
     result = era5sl_repo._get_file_list_for_period(existing_dates[0], existing_dates[0])
@@ -197,7 +246,7 @@ def test_repo_get_month_filename(_get_mock_repository_dir: Path):
     assert len(glob.glob(str(era5sl_repo.repository_folder.joinpath('ERA5SL')) + '*.*')) == 10  # Confirm file creation
 
     # FETCHING TEST 4:  Only temporary file types exist
-    # Expected result:  No valid files should be found, the temporary files should be removed from the folder
+    # Expected result:  No valid files should be found
     os.remove(Path(str(file_prefix) + ".nc"))
     os.remove(Path(str(file_prefix) + "_TEMP.nc"))
     os.remove(Path(str(file_prefix) + "_INCOMPLETE.nc"))
@@ -205,6 +254,32 @@ def test_repo_get_month_filename(_get_mock_repository_dir: Path):
     assert len(result) == 0
 
 
+def test_era5sl_repository_get_oldest_repository_file(_get_mock_repository_dir: Path):
+    era5sl_repo = ERA5SLRepository()
+    era5sl_repo.repository_folder = _get_mock_repository_dir
+
+    # OLDEST FILE TEST 1:   The repository is empty
+    # Expected result:      No identifier is returned
+    if era5sl_repo.repository_folder.exists():
+        shutil.rmtree(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+    assert era5sl_repo.get_oldest_repository_file() is None
+
+    # OLDEST FILE TEST 2:   Files of all types exist for two dates
+    # Expected result:      The identifier of the oldest date is returned
+    existing_dates = _fill_mock_repository(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+    oldest_date = min(existing_dates)
+    assert era5sl_repo.get_oldest_repository_file() == f"{oldest_date.year}_{str(oldest_date.month).zfill(2)}"
+
+    # OLDEST FILE TEST 3:   A new repository instance for the same folder skips the cleanup, as it was just done
+    # Expected result:      The identifier of the oldest date is still returned
+    new_era5sl_repo = ERA5SLRepository()
+    new_era5sl_repo.repository_folder = _get_mock_repository_dir
+    new_era5sl_repo._cleanup_if_due()
+    assert new_era5sl_repo.get_oldest_repository_file() == era5sl_repo.get_oldest_repository_file()
+
+
 def test_finalize_formatted_file(_get_mock_repository_dir):
     era5sl_repo = ERA5SLRepository()
     era5sl_repo.repository_folder = _get_mock_repository_dir
@@ -378,3 +453,125 @@ def test_era5sl_repository_update(monkeypatch, _get_mock_repository_dir, mock_co
     assert era5sl_repo.update()  # No errors expected
     files_in_repository = glob.glob(str(era5sl_repo.repository_folder.joinpath("*.*")))
     assert len(files_in_repository) == months_in_full_update  # Proper number of files
+
+
+def test_era5sl_repository_filter_dataset_by_coordinates():
+    era5sl_repo = ERA5SLRepository()
+
+    # SETUP: A small grid with a unique value for every location
+    timeline = pd.date_range(end=datetime.utcnow(), periods=24, freq="1H", closed="left")
+    lats = [51.5, 51.75, 52.0, 53.25]
+    lons = [5.5, 5.75, 6.0, 6.5]
+    values = np.arange(len(timeline) * len(lats) * len(lons), dtype=np.float64).reshape(
+        (len(timeline), len(lats), len(lons)))
+    ds = xr.Dataset(data_vars={"fake_factor_1": (["time", "lat", "lon"], values)},
+                    coords={"time": timeline, "lat": lats, "lon": lons})
+
+    # FILTER TEST 1:    Two locations that round to different grid points are requested
+    # Expected result:  Only the grid rows and columns for those points remain, with their original values
+    coordinates = [GeoPosition(51.873419, 5.705929), GeoPosition(53.2194, 6.5665)]
+    result = era5sl_repo._filter_dataset_by_coordinates(era5sl_repo.get_grid_coordinates(coordinates), ds)
+
+    assert list(result.lat.values) == [51.75, 53.25]
+    assert list(result.lon.values) == [5.75, 6.5]
+    assert result.sel(lat=51.75, lon=5.75).fake_factor_1.equals(ds.sel(lat=51.75, lon=5.75).fake_factor_1)
+    assert result.sel(lat=53.25, lon=6.5).fake_factor_1.equals(ds.sel(lat=53.25, lon=6.5).fake_factor_1)
+
+    # FILTER TEST 2:    A location outside of the grid is requested
+    # Expected result:  The location is left out without raising an error
+    coordinates = [GeoPosition(51.873419, 5.705929), GeoPosition(40.0, 2.0)]
+    result = era5sl_repo._filter_dataset_by_coordinates(era5sl_repo.get_grid_coordinates(coordinates), ds)
+    assert list(result.lat.values) == [51.75]
+    assert list(result.lon.values) == [5.75]
+
+
+def test_era5sl_repository_gather_period(_get_mock_repository_dir: Path):
+    era5sl_repo = ERA5SLRepository()
+    era5sl_repo.repository_folder = _get_mock_repository_dir
+
+    # SETUP: Create a clean mock repo-folder with repository files for two consecutive months
+    if era5sl_repo.repository_folder.exists():
+        shutil.rmtree(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+
+    first_month = (era5sl_repo.last_day_of_repo - relativedelta(months=5)).replace(day=1, hour=0)
+    months = [first_month, first_month + relativedelta(months=1)]
+    lats = [51.75, 52.0, 53.25]
+    lons = [5.75, 6.0, 6.5]
+
+    for month in months:
+        timeline = pd.date_range(start=month, periods=48, freq="1H")
+        ds = xr.Dataset(
+            data_vars={"fake_factor_1": (["time", "lat", "lon"],
+                                         np.full((len(timeline), len(lats), len(lons)), month.month, dtype=np.float64))},
+            coords={"time": timeline, "lat": lats, "lon": lons})
+        ds.to_netcdf(path=str(era5sl_repo.repository_folder.joinpath(_get_mock_prefix(month))) + '.nc',
+                     format="NETCDF4", engine="netcdf4")
+    era5sl_repo.cleanup()  # Registers the new files as found by a cleanup, like the next due cleanup would
+
+    # GATHER TEST 1:    A period spanning both files for two locations is requested
+    # Expected result:  The data of both files for only the requested locations is returned in a single dataset
+    coordinates = [GeoPosition(51.873419, 5.705929), GeoPosition(53.2194, 6.5665)]
+    result = era5sl_repo.gather_period(months[0], months[1] + relativedelta(days=1), coordinates)
+
+    assert list(result.lat.values) == [51.75, 53.25]
+    assert list(result.lon.values) == [5.75, 6.5]
+    assert len(result.time) == 96
+    assert result.get_index("time").is_monotonic_increasing
+    assert float(result.fake_factor_1.sel(time=months[0], lat=51.75, lon=5.75)) == months[0].month
+    assert float(result.fake_factor_1.sel(time=months[1], lat=53.25, lon=6.5)) == months[1].month
+
+    # GATHER TEST 2:    A period outside of the repository is requested
+    # Expected result:  A FileNotFoundError is raised, mentioning the oldest file in the repository
+    with pytest.raises(FileNotFoundError) as e:
+        era5sl_repo.gather_period(datetime(2010, 1, 1), datetime(2010, 2, 1), coordinates)
+    assert f"[{months[0].year}_{str(months[0].month).zfill(2)}]" in str(e.value)
+
+
+def test_era5sl_repository_load_file_selection_cache(_get_mock_repository_dir: Path):
+    era5sl_repo = ERA5SLRepository()
+    era5sl_repo.repository_folder = _get_mock_repository_dir
+
+    # SETUP: Create a clean mock repo-folder
+    if era5sl_repo.repository_folder.exists():
+        shutil.rmtree(era5sl_repo.repository_folder)
+    era5sl_repo.cleanup()
+
+    file_date = era5sl_repo.last_day_of_repo - relativedelta(months=5)
+    mock_file = str(era5sl_repo.repository_folder.joinpath(_get_mock_prefix(file_date))) + '.nc'
+    grid_coordinates = era5sl_repo.get_grid_coordinates([GeoPosition(51.873419, 5.705929)])
+    lat, lon = grid_coordinates[0].get_WGS84()
+
+    def write_mock_file(value: float):
+        # The file is written next to the repository file and then moved into place, like the repository does
+        timeline = pd.date_range(start=file_date.replace(day=1, hour=0), periods=24, freq="1H")
+        ds = xr.Dataset(data_vars={"fake_factor_1": (["time", "lat", "lon"],
+                                                     np.full((len(timeline), 1, 1), value, dtype=np.float64))},
+                        coords={"time": timeline, "lat": [lat], "lon": [lon]})
+        ds.to_netcdf(path=mock_file + '.new', format="NETCDF4", engine="netcdf4")
+        os.replace(mock_file + '.new', mock_file)
+
+    # CACHE TEST 1:     The same file is loaded twice
+    # Expected result:  The opened dataset is kept and reused
+    write_mock_file(1.0)
+    result = era5sl_repo._load_file_selection(mock_file, grid_coordinates)
+    opened_dataset = repository._opened_files[mock_file][1]
+    era5sl_repo._load_file_selection(mock_file, grid_coordinates)
+
+    assert float(result.fake_factor_1.isel(time=0)) == 1.0
+    assert repository._opened_files[mock_file][1] is opened_dataset
+
+    # CACHE TEST 2:     The file is replaced on disk with new data
+    # Expected result:  The new data is returned
+    write_mock_file(2.0)
+    os.utime(mock_file, ns=(os.stat(mock_file).st_atime_ns, os.stat(mock_file).st_mtime_ns + 1_000_000_000))
+    result = era5sl_repo._load_file_selection(mock_file, grid_coordinates)
+
+    assert float(result.fake_factor_1.isel(time=0)) == 2.0
+    assert repository._opened_files[mock_file][1] is not opened_dataset
+
+    # CACHE TEST 3:     The file is deleted from the repository
+    # Expected result:  The opened dataset is closed and no longer kept
+    era5sl_repo._safely_delete_file(mock_file)
+
+    assert mock_file not in repository._opened_files
@@ -8,15 +8,21 @@
 # repo_get_repository_location() isn't tested as it only fetches a value and if none is found a specific value is used.
 # A test would therefore be bigger and more error prone than the code itself.
 import glob
+import json
 import os
 import shutil
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
 from dateutil.relativedelta import relativedelta
 
 from app.routers.weather.sources.knmi.client.arome_repository import AromeRepository
+from app.routers.weather.sources.knmi.knmi_factors import arome_factors
+from app.routers.weather.utils.geo_position import GeoPosition
 
 
 def _get_mock_prefix(dummy_date: datetime):
@@ -129,6 +135,58 @@ def test_arome_repository_remove_file(_get_mock_repository_dir):
     assert str(e.value.args[0]) == f'Could not safely delete file: {non_existing_file}'
 
 
+def test_arome_repository_gather_period_overlapping_files(_get_mock_repository_dir: Path):
+    arome_repo = AromeRepository()
+    arome_repo.repository_folder = _get_mock_repository_dir
+
+    # SETUP: Create a clean mock repo-folder with three predictions, six hours apart and twelve hours long each.
+    #        Every prediction misses its last value, and only the last prediction holds the factor "y".
+    if arome_repo.repository_folder.exists():
+        shutil.rmtree(arome_repo.repository_folder)
+    arome_repo.cleanup()
+
+    coordinates = [GeoPosition(51.873419, 5.705929)]
+    grid_coordinate = arome_repo.get_grid_coordinates(coordinates)[0].get_WGS84()
+    first_prediction = (datetime.utcnow() - relativedelta(days=3)).replace(hour=0, minute=0, second=0, microsecond=0)
+    predictions = [first_prediction + relativedelta(hours=6 * index) for index in range(3)]
+
+    for index, prediction in enumerate(predictions):
+        timeline = pd.date_range(start=prediction, periods=12, freq="1H")
+        values = np.full((len(timeline), 1, 1), index + 1, dtype=np.float64)
+        values[-1] = np.nan
+        data_vars = {"x": (["time", "lat", "lon"], values)}
+        if index == 2:
+            data_vars["y"] = (["time", "lat", "lon"], values * 10)
+        ds = xr.Dataset(data_vars=data_vars,
+                        coords={"time": timeline, "lat": [grid_coordinate[0]], "lon": [grid_coordinate[1]]})
+        ds.to_netcdf(path=arome_repo.repository_folder.joinpath(_get_mock_prefix(prediction)),
+                     format="NETCDF4", engine="netcdf4")
+
+    # GATHER TEST 1:    A period holding all three predictions is requested
+    # Expected result:  Overlapping moments hold the values of the earliest prediction, unless that value is missing.
+    #                   The factor only held by the last prediction is added for the moments of that prediction.
+    result = arome_repo.gather_period(first_prediction - relativedelta(hours=1),
+                                      predictions[-1] + relativedelta(hours=1), coordinates)
+    x = result.x.sel(lat=grid_coordinate[0], lon=grid_coordinate[1])
+    y = result.y.sel(lat=grid_coordinate[0], lon=grid_coordinate[1])
+
+    assert len(result.time) == 24
+    assert float(x.sel(time=first_prediction + relativedelta(hours=5))) == 1.0
+    assert float(x.sel(time=first_prediction + relativedelta(hours=11))) == 2.0
+    assert float(x.sel(time=first_prediction + relativedelta(hours=17))) == 3.0
+    assert np.isnan(float(x.sel(time=first_prediction + relativedelta(hours=23))))
+    assert np.isnan(float(y.sel(time=first_prediction)))
+    assert float(y.sel(time=first_prediction + relativedelta(hours=12))) == 30.0
+
+
+def test_arome_factors_match_var_map():
+    # The AROME factor mapping is generated from arome_var_map.json by scripts/generate_arome_var_map.py.
+    # If this test fails, the script needs to be run again.
+    var_map_file = Path(__file__).parent.parent.joinpath("app", "routers", "weather", "sources", "knmi",
+                                                         "arome_var_map.json")
+    assert dict(arome_factors) == json.loads(var_map_file.read_bytes())
+
+
 @pytest.mark.skip(reason="Still to be implemented")
 def test_arome_repository_update(monkeypatch):
     # Full test for the update system. Downloads are intercepted by corresponding mock functions.